@@ -1,11 +1,40 @@
 from matplotlib import pyplot as plt
 import numpy as np
 from collections import OrderedDict
-from collections import Counter
+from functools import lru_cache
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Compiled from dnd_kernels.pyx with `cythonize -i dnd_kernels.pyx`
+try:
+    from dnd_kernels import attack_kernel
+except ImportError:
+    attack_kernel = None
+
+_RNG = np.random.Generator(np.random.PCG64DXSM())
+
+# Largest value range ReturnFrequencies counts with np.bincount
+_BINCOUNT_MAX_SPAN = 4096
+
+# Number of simulations the numba kernel runs per seed
+_KERNEL_CHUNK = 1 << 16
+
+# The numba attack kernel draws one scalar random number per die, which is
+# about 2x slower per thread than the numpy path, and the parallel bincount
+# only beats np.bincount with several threads. Only use them with enough
+# threads and values to make up for that. These thresholds haven't been
+# measured on a multi-core machine yet, so the kernels are off unless
+# _USE_NUMBA_KERNELS is set to True.
+_USE_NUMBA_KERNELS = False
+_NUMBA_KERNEL_MIN_THREADS = 4
+_NUMBA_KERNEL_MIN_SIZE = 1 << 19
 
 
 def GetRollValue(roll, n):
-    """Return a 2D numpy array of random rolls
+    """Return a numpy array of random rolls
 
     args:
         roll: string. The type of dice that needs to be rolled. ie 1D6, 2D8, ect
@@ -14,71 +43,353 @@ def GetRollValue(roll, n):
         n: The number of times to repeat the simulation
 
     returns:
-        An array where each element is the result of the dice roll
+        An int16 array where each element is the result of the dice roll
     """
     n = int(n)
+    (die, val, flat) = _parse_roll(roll)
+    if die == 0:
+        return np.full(n, flat, dtype=np.int16)
+    rolls = _RNG.integers(1, val + 1, size=(die, n), dtype=_dice_dtype(val))
+    return rolls.sum(axis=0, dtype=np.int16)
+
+
+def _dice_dtype(val):
+    """The smallest dtype that holds a roll of a die with val sides"""
+    return np.int8 if val <= np.iinfo(np.int8).max else np.int16
+
+
+@lru_cache(maxsize=None)
+def _parse_roll(roll):
+    """Parse a dice string into a (die, val, flat) tuple
+
+    args:
+        roll: string or int. The type of dice that needs to be rolled. ie 1D6,
+            2D8, ect. If an int or a single character is given, this will
+            assume that it is a flat damage modifier.
+
+    returns:
+        (die, val, flat): The number of dice, the number of sides on each die
+            and the flat damage modifier.
+    """
     if type(roll) == int:
-        return np.ones(n) * roll
+        return (0, 0, roll)
     elif len(roll) == 1:
-        return np.ones(n) * int(roll)
+        return (0, 0, int(roll))
     else:
-        roll = roll.upper()
-        (die, val) = list(map(int, roll.split('D')))
-        return sum(np.random.randint(1, val + 1, size=(die, n)))
+        (die, val) = list(map(int, roll.upper().split('D')))
+        return (die, val, 0)
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _dice_kernel(die, val):
+        """Sum of a single roll of `die` dice with `val` sides"""
+        total = 0
+        for _ in range(die):
+            total += np.random.randint(1, val + 1)
+        return total
+
+    @numba.njit(parallel=True, cache=True)
+    def _attack_kernel(dies, vals, crits, success_flat, critical_flat, n,
+                       seed):
+        """Fused Monte Carlo attack loop, see _roll_attack
+
+        args:
+            dies, vals, crits, success_flat, critical_flat: The output of
+                _compile_actions.
+            n: int. The number of Monte Carlo simulations to run.
+            seed: int. Seed for the random number generator. Each chunk of
+                _KERNEL_CHUNK simulations is seeded separately, so the result
+                doesn't depend on how the chunks are spread over threads.
+
+        returns:
+            (hit_success_damage, hit_critical_damage, hit): int16, int16 and
+                int8 arrays. See _roll_attack.
+        """
+        hit_success_damage = np.zeros(n, dtype=np.int16)
+        hit_critical_damage = np.zeros(n, dtype=np.int16)
+        hit = np.empty(n, dtype=np.int8)
+        num_chunks = (n + _KERNEL_CHUNK - 1) // _KERNEL_CHUNK
+        for chunk in numba.prange(num_chunks):
+            np.random.seed(seed + chunk)
+            for i in range(chunk * _KERNEL_CHUNK,
+                           min(n, (chunk + 1) * _KERNEL_CHUNK)):
+                hit[i] = np.random.randint(1, 21)
+                success = success_flat
+                critical = critical_flat
+                for a in range(dies.shape[0]):
+                    success += _dice_kernel(dies[a], vals[a])
+
+                    # Roll again for a critical hit, only if there is one
+                    if crits[a] and hit[i] == 20:
+                        critical += _dice_kernel(dies[a], vals[a])
+
+                hit_success_damage[i] = success
+                hit_critical_damage[i] = critical
+        return hit_success_damage, hit_critical_damage, hit
+
+    @numba.njit(parallel=True, cache=True)
+    def _parallel_bincount(values, offset, span, num_threads):
+        """Same as np.bincount(values - offset), counted in per-thread bins
+
+        args:
+            values: array of ints. The values to count, in any integer dtype.
+            offset: int. The smallest value.
+            span: int. The largest value minus the smallest value.
+            num_threads: int. The number of blocks to split the values into.
+
+        returns:
+            value_counts: int64 array of length span + 1.
+        """
+        local_counts = np.zeros((num_threads, span + 1), dtype=np.int64)
+        block = (values.shape[0] + num_threads - 1) // num_threads
+        for t in numba.prange(num_threads):
+            for i in range(t * block, min(values.shape[0], (t + 1) * block)):
+                local_counts[t, values[i] - offset] += 1
+        return local_counts.sum(axis=0)
+
+
+def _use_numba_kernel(size):
+    """True if the numba kernels should handle an input of the given size"""
+    return (_USE_NUMBA_KERNELS and numba is not None and
+            size >= _NUMBA_KERNEL_MIN_SIZE and
+            numba.get_num_threads() >= _NUMBA_KERNEL_MIN_THREADS)
+
+
+def _generator(seed=None):
+    """Returns the module random generator, or a new one seeded with seed"""
+    if seed is None:
+        return _RNG
+    return np.random.Generator(np.random.PCG64DXSM(seed))
+
+
+def _compile_actions(actions):
+    """Splits the damage dice of an attack into one array per property
 
+    args:
+        actions: Dict. See MonteCarloAttack.
 
-def MonteCarloAttack(actions, ac=14, n=1e3):
-    """Returns damage done to a target with the specified AC
+    returns:
+        dies: int64 array. The number of dice rolled for each dice action.
+        vals: int64 array. The number of sides of the dice of each action.
+        crits: bool array. True if the action is rolled again for a critical
+            hit. The proficiency bonus is not.
+        success_flat: int. The sum of all flat damage modifiers.
+        critical_flat: int. The sum of the flat damage modifiers that are
+            added again for a critical hit.
+    """
+    dies = []
+    vals = []
+    crits = []
+    success_flat = 0
+    critical_flat = 0
+
+    # The hit modifier is not a damage roll so it is left out
+    for action, roll in actions.items():
+        if action == 'hit':
+            continue
+        (die, val, flat) = _parse_roll(roll)
+        crit = action != 'prof'
+        success_flat += flat
+        if crit:
+            critical_flat += flat
+        if die:
+            dies.append(die)
+            vals.append(val)
+            crits.append(crit)
+
+    return (np.array(dies, dtype=np.int64), np.array(vals, dtype=np.int64),
+            np.array(crits, dtype=bool), success_flat, critical_flat)
+
+
+def _roll_dice(dies, vals, rng, out):
+    """Sums a roll of the dice of every action into out
 
     args:
-        actions: Dict. A dictionary of all supplements for a given attack. Each
-            key corresponds with the name of an effect to stack (ie hunter's
-            mark, longbow...). Each value corresponds with the dice roll
-            associated with the attack (ie 1D6, 1D8, ...). One of the key-value
-            pairs should be "hit" to take into account your hit modifier.
-        ac: int. The armor class of the target. Used to determine if an attack
-            is successful.
+        dies: int64 array. The number of dice rolled for each action.
+        vals: int64 array. The number of sides of the dice of each action.
+        rng: numpy Generator. The random generator to roll with.
+        out: int16 array. One sum is written per element, so its length is
+            the number of simulations.
+
+    returns:
+        out
+    """
+    n = out.shape[0]
+    out[:] = 0
+
+    # Draw every die with the same number of sides in a single call, and
+    # reduce each of those groups in one pass
+    dice_sum = np.empty(n, dtype=np.int16)
+    for val in np.unique(vals):
+        draws = rng.integers(1, val + 1, size=(dies[vals == val].sum(), n),
+                             dtype=_dice_dtype(val))
+        np.add.reduce(draws, axis=0, dtype=np.int16, out=dice_sum)
+        out += dice_sum
+    return out
+
+
+def _roll_attack(actions, n, rng=_RNG):
+    """Rolls the damage and hit dice of an attack, independent of the AC
+
+    args:
+        actions: Dict. See MonteCarloAttack.
         n: int. The number of Monte Carlo simulations to run.
+        rng: numpy Generator. The random generator to roll with.
 
     returns:
-        final_damage: list of ints. The final damage done for each simulation
-            iteration
+        hit_success_damage: int16 array. The damage done on a hit.
+        hit_critical_damage: int16 array. The extra damage done on a critical.
+            The dice are only rolled where hit is 20.
+        hit: int8 array. The 1D20 hit roll, without the hit modifier.
     """
     n = int(n)
-    hit_success_damage = np.zeros(n)
-    hit_critical_damage = np.zeros(n)
+    (dies, vals, crits, success_flat, critical_flat) = \
+        _compile_actions(actions)
+
+    # Run the whole simulation in a single compiled loop when the Cython
+    # kernel has been built, or when the numba kernel is switched on and has
+    # enough threads to beat numpy
+    if attack_kernel is not None:
+        seed = int(rng.integers(2 ** 63))
+        return attack_kernel(dies, vals, crits.view(np.uint8), success_flat,
+                             critical_flat, n, seed)
+    if _use_numba_kernel(n):
+        seed = int(rng.integers(2 ** 31))
+        return _attack_kernel(dies, vals, crits, success_flat, critical_flat,
+                              n, seed)
+
+    hit = rng.integers(1, 21, size=n, dtype=np.int8)
 
     # Calculate Damage Assuming All Hits
-    for action, roll in actions.items():
+    hit_success_damage = np.empty(n, dtype=np.int16)
+    _roll_dice(dies, vals, rng, out=hit_success_damage)
 
-        # Don't include the hit modifier
-        if action == 'hit':
-            continue
+    # Roll again for a critical hit, but only for the simulations that rolled
+    # a natural 20
+    hit_critical_damage = np.zeros(n, dtype=np.int16)
+    crit_idx = np.flatnonzero(hit == 20)
+    if crit_idx.size:
+        critical_damage = np.empty(crit_idx.size, dtype=np.int16)
+        _roll_dice(dies[crits], vals[crits], rng, out=critical_damage)
+        hit_critical_damage[crit_idx] = critical_damage
 
-        hit_success_damage += GetRollValue(roll, n)
+    # Add the flat damage modifiers as one constant each
+    hit_success_damage += success_flat
+    hit_critical_damage += critical_flat
 
-        # Don't include the proficiency bonus for a critical
-        if action == 'prof':
-            continue
+    return hit_success_damage, hit_critical_damage, hit
+
+
+@lru_cache(maxsize=4)
+def _cached_rolls(actions_key, n, index, seed):
+    """Same as _roll_attack, but memoized for repeated seeded AC sweeps
+
+    args:
+        actions_key: tuple. The sorted items of the actions dictionary.
+        n: int. The number of Monte Carlo simulations to run.
+        index: int. The position of the attack in the list of attacks, so
+            identical attacks made in the same turn get their own rolls.
+        seed: int. Seed for the dice rolls. The first attack is seeded the
+            same way as MonteCarloAttack, so both draw the same sample.
+
+    returns:
+        The output of _roll_attack, as read-only arrays.
+    """
+    rng = _generator(seed if index == 0 else [seed, index])
+    rolls = _roll_attack(dict(actions_key), n, rng=rng)
+    for array in rolls:
+        array.setflags(write=False)
+    return rolls
 
-        # Roll again for a critical hit
-        hit_critical_damage += GetRollValue(roll, n)
 
-    # Check for Hit
-    hit = GetRollValue('1D20', n)
-    hit_success = hit + actions['hit'] >= ac
-    hit_critical = hit == 20
-    hit_absolute_miss = hit != 0
+def _prepare_hits(rolls, hit_mod):
+    """Works out everything about the hit roll that doesn't depend on the AC
 
-    # Tally up final damage
-    hit_success_damage_final = hit_success_damage * hit_success
-    hit_critical_damage_final = hit_critical_damage * hit_critical
-    final_damage = hit_success_damage_final + hit_critical_damage_final
-    final_damage *= hit_absolute_miss
+    args:
+        rolls: tuple of arrays. The output of _roll_attack.
+        hit_mod: int. The hit modifier of the attack.
+
+    returns:
+        hit_total: int16 array. The 1D20 hit roll plus the hit modifier.
+        natural_1: int array. The simulations that rolled a natural 1.
+        natural_20: int array. The simulations that rolled a natural 20.
+        hit_critical_damage_final: int16 array. The total damage done on a
+            critical hit.
+    """
+    (hit_success_damage, hit_critical_damage, hit) = rolls
+
+    hit_total = np.empty(hit.shape, dtype=np.int16)
+    np.add(hit, hit_mod, out=hit_total, dtype=np.int16)
+
+    hit_critical_damage_final = np.empty(hit.shape, dtype=np.int16)
+    np.add(hit_success_damage, hit_critical_damage,
+           out=hit_critical_damage_final)
+
+    return (hit_total, np.flatnonzero(hit == 1), np.flatnonzero(hit == 20),
+            hit_critical_damage_final)
+
+
+def _apply_ac(rolls, hits, ac):
+    """Returns the damage done by rolls from _roll_attack against an AC
+
+    args:
+        rolls: tuple of arrays. The output of _roll_attack.
+        hits: tuple of arrays. The output of _prepare_hits for the rolls. It
+            doesn't depend on the AC, so it can be shared between ACs.
+        ac: int. The armor class of the target.
+
+    returns:
+        final_damage: int16 array. The final damage done for each simulation
+            iteration
+    """
+    hit_success_damage = rolls[0]
+    (hit_total, natural_1, natural_20, hit_critical_damage_final) = hits
+
+    # Check for Hit. Each simulation is either a miss (0), an ordinary hit (1)
+    # or a critical hit (2). A natural 1 always misses and a natural 20 always
+    # hits.
+    category = np.empty(hit_total.shape, dtype=np.int8)
+    np.greater_equal(hit_total, ac, out=category.view(np.bool_))
+    category[natural_20] = 2
+    category[natural_1] = 0
+
+    # Tally up final damage. The rolls are shared between ACs, so write into
+    # a new buffer rather than in place.
+    final_damage = np.empty(hit_total.shape, dtype=np.int16)
+    np.choose(category, (0, hit_success_damage, hit_critical_damage_final),
+              out=final_damage)
 
     return final_damage
 
 
+def MonteCarloAttack(actions, ac=14, n=1e3, seed=None):
+    """Returns damage done to a target with the specified AC
+
+    args:
+        actions: Dict. A dictionary of all supplements for a given attack. Each
+            key corresponds with the name of an effect to stack (ie hunter's
+            mark, longbow...). Each value corresponds with the dice roll
+            associated with the attack (ie 1D6, 1D8, ...). One of the key-value
+            pairs should be "hit" to take into account your hit modifier.
+        ac: int. The armor class of the target. Used to determine if an attack
+            is successful.
+        n: int. The number of Monte Carlo simulations to run.
+        seed: int. Seed for the dice rolls. If None, the module wide random
+            generator is used. A seed only reproduces results within the same
+            environment: the numpy, numba and Cython roll paths each use a
+            different generator, so they give different samples for the same
+            seed.
+
+    returns:
+        final_damage: list of ints. The final damage done for each simulation
+            iteration
+    """
+    rolls = _roll_attack(actions, n, rng=_generator(seed))
+    return _apply_ac(rolls, _prepare_hits(rolls, actions['hit']), ac)
+
+
 def ReturnFrequencies(list_of_values):
     """Gives the frequency (%) of each value in a list
 
@@ -91,10 +402,33 @@ def ReturnFrequencies(list_of_values):
             that value.
     """
     frequency_dict = OrderedDict()
-    value_counts = Counter(list_of_values)
-    total_counts = sum(value_counts.values())
-    for key, value in sorted(value_counts.items()):
-        frequency_dict[key] = float(value) / total_counts * 100
+    values = np.asarray(list_of_values)
+    if values.dtype.kind not in 'iu':
+        values = values.astype(np.int32)
+    if values.size == 0:
+        return frequency_dict
+
+    # Count in bins offset by the smallest value, so negative values work too.
+    # Wide ranges go through np.histogram with unit-width bin edges instead.
+    # That sorts and searches the values, so it is slower than np.bincount,
+    # and it still allocates a count per value in the range. Large inputs can
+    # be counted by numba without copying them to a wider dtype.
+    offset = int(values.min())
+    span = int(values.max()) - offset
+    if span < _BINCOUNT_MAX_SPAN and _use_numba_kernel(values.size):
+        value_counts = _parallel_bincount(values, offset, span,
+                                          numba.get_num_threads())
+    elif span < _BINCOUNT_MAX_SPAN:
+        shifted = values.astype(np.intp)
+        shifted -= offset
+        value_counts = np.bincount(shifted)
+    else:
+        (value_counts, _) = np.histogram(
+            values, bins=np.arange(offset, offset + span + 2))
+    total_counts = value_counts.sum()
+    for key in np.nonzero(value_counts)[0]:
+        frequency_dict[int(key) + offset] = \
+            float(value_counts[key]) / total_counts * 100
 
     return frequency_dict
 
@@ -105,18 +439,15 @@ def PlotFrequencies(frequency_dict, label=None, **kwargs):
     args:
         list_of_values: list of ints. A list of integers to count
     """
-    values = []
-    frequencies = []
-
-    for value, frequency in frequency_dict.items():
-        values += [value]
-        frequencies += [frequency]
+    items = np.fromiter(frequency_dict.items(),
+                        dtype=[('value', np.int32), ('frequency', np.float64)],
+                        count=len(frequency_dict))
 
-    plt.plot(values, frequencies, marker='o', markeredgecolor='black',
-             label=label, **kwargs)
+    plt.plot(items['value'], items['frequency'], marker='o',
+             markeredgecolor='black', label=label, **kwargs)
 
 
-def PlotAcDistribution(actions_list, acs, n, ignore_miss=True):
+def PlotAcDistribution(actions_list, acs, n, ignore_miss=True, seed=None):
     """Plots the Monte Carlo distribution results versus armor class
 
     args:
@@ -131,16 +462,33 @@ def PlotAcDistribution(actions_list, acs, n, ignore_miss=True):
         n: int. Number of simulations to run.
         ignore_miss: Bool. True if all attacks that result in a miss should be
             ignored.
+        seed: int. Seed for the dice rolls. If None, the module wide random
+            generator is used. A seed only reproduces results within the same
+            environment: the numpy, numba and Cython roll paths each use a
+            different generator, so they give different samples for the same
+            seed.
     """
     if isinstance(actions_list, dict):
         actions_list = [actions_list]
 
+    # The damage rolls don't depend on the AC, so roll them once and only
+    # redo the hit check for each AC. Seeded rolls are also kept around for
+    # the next call with the same attacks and seed.
+    if seed is None:
+        rolls_list = [_roll_attack(actions, n) for actions in actions_list]
+    else:
+        rolls_list = [_cached_rolls(tuple(sorted(actions.items())), int(n),
+                                    index, seed)
+                      for index, actions in enumerate(actions_list)]
+    hits_list = [_prepare_hits(rolls, actions['hit'])
+                 for actions, rolls in zip(actions_list, rolls_list)]
+
     for ac in acs:
 
         sim_damage_results = 0
 
-        for actions in actions_list:
-            sim_damage_results += MonteCarloAttack(actions, ac, n=n)
+        for rolls, hits in zip(rolls_list, hits_list):
+            sim_damage_results += _apply_ac(rolls, hits, ac)
 
         if ignore_miss:
             sim_damage_results = sim_damage_results[sim_damage_results > 0]
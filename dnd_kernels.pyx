@@ -0,0 +1,69 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""Compiled attack kernel used by DND_Functions when it has been built
+
+Build in place with:
+    cythonize -i dnd_kernels.pyx
+"""
+import numpy as np
+
+from libc.stdint cimport int8_t, int16_t, int64_t, uint8_t, uint64_t
+
+
+cdef inline uint64_t _next(uint64_t *state) noexcept nogil:
+    """splitmix64 step"""
+    state[0] += 0x9E3779B97F4A7C15ULL
+    cdef uint64_t z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+
+cdef inline int64_t _die(uint64_t *state, int64_t val) noexcept nogil:
+    """A single roll of a die with `val` sides"""
+    return <int64_t>(((_next(state) >> 32) * <uint64_t>val) >> 32) + 1
+
+
+cpdef attack_kernel(int64_t[:] dies, int64_t[:] vals, uint8_t[:] crits,
+                    int64_t success_flat, int64_t critical_flat, Py_ssize_t n,
+                    uint64_t seed):
+    """Fused Monte Carlo attack loop, see DND_Functions._roll_attack
+
+    args:
+        dies, vals, crits, success_flat, critical_flat: The output of
+            DND_Functions._compile_actions, with crits viewed as uint8.
+        n: int. The number of Monte Carlo simulations to run.
+        seed: int. Seed for the random number generator.
+
+    returns:
+        (hit_success_damage, hit_critical_damage, hit): int16, int16 and int8
+            arrays. See DND_Functions._roll_attack.
+    """
+    hit_success_damage_arr = np.empty(n, dtype=np.int16)
+    hit_critical_damage_arr = np.empty(n, dtype=np.int16)
+    hit_arr = np.empty(n, dtype=np.int8)
+    cdef int16_t[:] hit_success_damage = hit_success_damage_arr
+    cdef int16_t[:] hit_critical_damage = hit_critical_damage_arr
+    cdef int8_t[:] hit = hit_arr
+    cdef uint64_t state = seed
+    cdef Py_ssize_t i, a, d
+    cdef Py_ssize_t num_actions = dies.shape[0]
+    cdef int64_t success, critical
+
+    with nogil:
+        for i in range(n):
+            hit[i] = <int8_t>_die(&state, 20)
+            success = success_flat
+            critical = critical_flat
+            for a in range(num_actions):
+                for d in range(dies[a]):
+                    success += _die(&state, vals[a])
+
+                # Roll again for a critical hit, only if there is one
+                if crits[a] and hit[i] == 20:
+                    for d in range(dies[a]):
+                        critical += _die(&state, vals[a])
+
+            hit_success_damage[i] = <int16_t>success
+            hit_critical_damage[i] = <int16_t>critical
+
+    return hit_success_damage_arr, hit_critical_damage_arr, hit_arr